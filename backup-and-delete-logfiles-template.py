@@ -7,109 +7,390 @@
 # Cheers!  -  Fernando Cabal   - 02 April 2025
 """
 import os
-import shutil
-import gzip
+import atexit
+import errno
+import mmap
 import time
 import logging
+import logging.handlers
 import sys
+import multiprocessing
+import queue
+import threading
+import contextlib
+import itertools
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    # ISA-L's igzip is a faster drop-in replacement for gzip, if installed
+    from isal import igzip as gzip_mod
+    COMPRESS_LEVEL = 1  # ISA-L level 1 compresses about as well as zlib level 6
+except ImportError:
+    import gzip as gzip_mod
+    COMPRESS_LEVEL = 6
+
+# 1 MiB chunks for reading, compressing and writing large log files
+BUFFER_SIZE = 1024 * 1024
+# Files larger than this are compressed and deleted
+THRESHOLD_BYTES = 500 * 1024 * 1024
+# Chunks read in the background ahead of the compressor
+READ_AHEAD_DEPTH = 8
+# Log records buffered before they are written to the log file
+LOG_BUFFER_CAPACITY = 1024
+
+# Compression workers are started with forkserver, or spawn where it is
+# missing. Workers are then started only when there is work for them, and
+# are never forked from this process while its logging threads run.
+MP_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# Log records from this process and the compression workers go through this
+# queue to a single listener thread that does the formatting and the writes
+_log_queue = None
+_log_listener = None
+
+def _start_log_listener(*handlers):
+    """
+    Starts the listener thread that passes the records put on _log_queue to
+    the given handlers.
+
+    Args:
+        *handlers (logging.Handler): The handlers the records go to.
+    """
+    global _log_queue, _log_listener
+    # A multiprocessing queue, so that worker processes can log to it too
+    _log_queue = MP_CONTEXT.Queue(-1)
+    _log_listener = logging.handlers.QueueListener(_log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    # Runs before logging's own shutdown hook, which was registered first
+    atexit.register(_log_listener.stop)
 
 def configure_logging(log_file_path):
     """
-    Configures logging to write to a specified log file.
+    Configures logging to write to a specified log file. If the caller has
+    already configured logging, its handlers are kept and only receive the
+    records of the compression workers through the queue.
+
+    Logging calls only put the record on a queue, a background listener
+    writes it to the log file and the console.
 
     Args:
         log_file_path (str): The path to the log file.
     """
+    root = logging.getLogger()
+    if root.handlers:
+        if _log_queue is None:
+            # Configured by the caller, worker processes still log to its handlers
+            _start_log_listener(*root.handlers)
+        return
+
     # Create the directory if it doesn't exist
     log_dir = os.path.dirname(log_file_path)
-    if log_dir and not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
 
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_file_path),
-            logging.StreamHandler(sys.stdout)  # Also log to console
-        ]
-    )
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    # Only open the log file once there is something to write
+    file_handler = logging.FileHandler(log_file_path, delay=True)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler(sys.stdout)  # Also log to console
+    console_handler.setFormatter(formatter)
 
-def get_file_size_mb(file_path):
+    _start_log_listener(
+        # Write the log file in batches, errors are written right away
+        logging.handlers.MemoryHandler(LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR,
+                                       target=file_handler),
+        console_handler)
+
+    root.addHandler(logging.handlers.QueueHandler(_log_queue))
+    root.setLevel(logging.INFO)
+
+def read_chunks(read, read_ahead=0):
     """
-    Gets the size of a file in megabytes.
+    Yields the chunks returned by read() until it returns b''. With read_ahead,
+    a background thread keeps that many chunks queued so disk reads overlap
+    with compression (file reads and zlib both release the GIL).
 
     Args:
-        file_path (str): The path to the file.
-
-    Returns:
-        float: The size of the file in megabytes, or 0 if the file does not exist or an error occurs.
+        read (callable): Returns the next chunk, or b'' at end of file.
+        read_ahead (int): Number of chunks to read ahead, 0 to read synchronously.
     """
+    if not read_ahead:
+        yield from iter(read, b'')
+        return
+
+    chunks = queue.Queue(maxsize=read_ahead)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                chunk = read()
+                chunks.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            chunks.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
     try:
-        if os.path.exists(file_path):
-            return os.path.getsize(file_path) / (1024 * 1024)  # Convert bytes to MB
-        else:
-            logging.warning(f"File not found: {file_path}")
-            return 0
-    except Exception as e:
-        logging.error(f"Error getting file size for {file_path}: {e}")
-        return 0
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        # Free up the queue so a blocked reader can see the stop flag
+        stop.set()
+        while not chunks.empty():
+            chunks.get_nowait()
+        thread.join()
 
-def compress_file(input_file, output_file):
+def advise(fd, advice):
     """
-    Compresses a file using gzip.
+    Gives the kernel a hint about how a whole file will be accessed. Does
+    nothing where posix_fadvise is not available (e.g. macOS).
+
+    Args:
+        fd (int): An open file descriptor.
+        advice (str): Name of an os.POSIX_FADV_* constant.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+@contextlib.contextmanager
+def open_for_reading(input_file, buffers=1):
+    """
+    Opens a file to be read once in BUFFER_SIZE chunks. Where the filesystem
+    supports O_DIRECT the file is read straight into an aligned buffer, so a
+    large log does not go through the page cache and evict other data.
+
+    Chunks are memoryviews into a ring of preallocated buffers that are
+    reused round-robin, so no new bytes object is allocated per chunk. A
+    chunk is overwritten by the read that comes `buffers` reads later.
 
     Args:
         input_file (str): The path to the input file.
-        output_file (str): The path to the output (compressed) file.
+        buffers (int): Number of chunks that can be in use at the same time.
+
+    Yields:
+        callable: Returns the next chunk, or an empty chunk at end of file.
     """
+    # O_DIRECT needs aligned buffers, anonymous mmaps are page aligned.
+    # The mmap is unmapped once the last chunk pointing into it is released.
+    ring = memoryview(mmap.mmap(-1, BUFFER_SIZE * buffers))
+    views = itertools.cycle([ring[i:i + BUFFER_SIZE] for i in range(0, len(ring), BUFFER_SIZE)])
+
+    fd = None
+    if hasattr(os, 'O_DIRECT'):
+        try:
+            fd = os.open(input_file, os.O_RDONLY | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    if fd is None:
+        # O_DIRECT is not supported here (e.g. tmpfs or macOS), use buffered reads
+        with open(input_file, 'rb', buffering=BUFFER_SIZE) as infile:
+            # The log is read once from start to end, then deleted
+            advise(infile.fileno(), 'POSIX_FADV_SEQUENTIAL')
+
+            def read_buffered():
+                view = next(views)
+                return view[:infile.readinto(view)]
+
+            yield read_buffered
+            advise(infile.fileno(), 'POSIX_FADV_DONTNEED')
+        return
+
+    def read_direct():
+        view = next(views)
+        return view[:os.readv(fd, [view])]
+
     try:
-        with open(input_file, 'rb') as infile, gzip.open(output_file, 'wb') as outfile:
-            shutil.copyfileobj(infile, outfile)
-        logging.info(f"Successfully compressed {input_file} to {output_file}")
-        return True
-    except Exception as e:
-        logging.error(f"Error compressing file {input_file}: {e}")
-        return False
+        yield read_direct
+        # Drop whatever other readers may have left in the cache
+        advise(fd, 'POSIX_FADV_DONTNEED')
+    finally:
+        os.close(fd)
 
-def copy_file(src_file, dest_file):
+def compress_file(input_file, output_file, read_ahead=READ_AHEAD_DEPTH):
     """
-    Copies a file from source to destination.
+    Compresses a file using gzip.
 
     Args:
-        src_file (str): Path to the source file.
-        dest_file (str): Path to the destination file.
+        input_file (str): The path to the input file.
+        output_file (str): The path to the output (compressed) file.
+        read_ahead (int): Number of chunks read ahead of the compressor, 0 to disable.
     """
     try:
-        # Ensure the destination directory exists
-        dest_dir = os.path.dirname(dest_file)
-        if dest_dir and not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
-        shutil.copy2(src_file, dest_file)  # copy with metadata
-        logging.info(f"Successfully copied {src_file} to {dest_file}")
+        # Chunks can be queued, being compressed, or being read into
+        with open_for_reading(input_file, buffers=read_ahead + 2) as read, \
+                open(output_file, 'wb', buffering=BUFFER_SIZE) as rawfile:
+            chunks = read_chunks(read, read_ahead)
+            with contextlib.closing(chunks), \
+                    gzip_mod.GzipFile(fileobj=rawfile, mode='wb', compresslevel=COMPRESS_LEVEL) as outfile:
+                for chunk in chunks:
+                    outfile.write(chunk)
+            # Make sure the archive is on disk before the original gets deleted
+            rawfile.flush()
+            os.fsync(rawfile.fileno())
+            # The archive is not read again, its pages can go once they are on disk
+            advise(rawfile.fileno(), 'POSIX_FADV_DONTNEED')
+        logging.info("Successfully compressed %s to %s", input_file, output_file)
         return True
     except Exception as e:
-        logging.error(f"Error copying file {src_file} to {dest_file}: {e}")
+        logging.error("Error compressing file %s: %s", input_file, e)
         return False
-    
+
 def delete_file(file_path):
     """
-    Deletes a file.
+    Deletes a file. A file that is already gone counts as deleted.
 
     Args:
         file_path (str): The path to the file to delete.
     """
     try:
         os.remove(file_path)
-        logging.info(f"Successfully deleted file: {file_path}")
+        logging.info("Successfully deleted file: %s", file_path)
+        return True
+    except FileNotFoundError:
+        logging.warning("File already deleted: %s", file_path)
         return True
     except Exception as e:
-        logging.error(f"Error deleting file {file_path}: {e}")
+        logging.error("Error deleting file %s: %s", file_path, e)
         return False
 
+def _init_worker(log_queue, level):
+    """
+    Sends the log records of a compression worker process to the parent's
+    log listener.
+
+    Args:
+        log_queue (multiprocessing.Queue): The queue the listener reads from.
+        level (int): The level of the parent's root logger.
+    """
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+
+def _compress_one(files):
+    """
+    Compresses a file in a worker process. The original is left in place so
+    that deletions stay in the parent process.
+
+    Args:
+        files (tuple): Paths to the source file and to the output (compressed) file.
+
+    Returns:
+        tuple: Whether the compression succeeded, and the path to the source file.
+    """
+    src_file, compressed_file = files
+    return compress_file(src_file, compressed_file), src_file
+
+def _scan_large_files(dir1, dir2):
+    """
+    Scans dir1 for log files larger than 500MB.
+
+    Args:
+        dir1 (str): The path to the source directory.
+        dir2 (str): The path to the destination directory.
+
+    Yields:
+        tuple: Paths to a large file and to its compressed file in dir2.
+    """
+    with os.scandir(dir1) as entries:
+        for entry in entries:
+            # DirEntry knows the file type from the directory scan (d_type), so only
+            # regular files cost a stat call for their size.
+            # TO DO : on macOS, getattrlistbulk could return names, types and sizes
+            # for a whole batch of entries in one call.
+            if not entry.is_file(follow_symlinks=False):
+                continue  # Skip directories, symlinks and non-files
+
+            src_file = entry.path
+            try:
+                file_size = entry.stat(follow_symlinks=False).st_size
+            except OSError as e:
+                # Rotated or removed since the directory was read
+                logging.warning("Error getting file size for %s: %s", src_file, e)
+                continue
+            if file_size <= THRESHOLD_BYTES:
+                logging.info("Skipping file: %s (%d MB) - Size is not greater than 500MB", src_file, file_size >> 20)
+                continue
+
+            logging.info("Found large file: %s (%d MB)", src_file, file_size >> 20)
+
+            # Create destination filename
+            compressed_file = os.path.join(dir2, entry.name + '.gz')
+            yield src_file, compressed_file
+
+async def _process(dir1, dir2, executor, workers):
+    """
+    Compresses the large log files of dir1 into dir2 and deletes the
+    originals, as a pipeline: the scan feeds a bounded queue, compression
+    workers take files from it as they become free, and a deleter removes
+    each original as soon as its archive is written. Scanning the next file
+    and deleting the previous one both overlap with compression.
+
+    Args:
+        dir1 (str): The path to the source directory.
+        dir2 (str): The path to the destination directory.
+        executor (ProcessPoolExecutor): The pool the files are compressed in.
+        workers (int): Number of files compressed at the same time.
+    """
+    loop = asyncio.get_running_loop()
+    to_compress = asyncio.Queue(maxsize=workers)
+    to_delete = asyncio.Queue()
+
+    async def walker():
+        # The scan blocks on readdir and lstat, so it runs in a thread
+        scan = _scan_large_files(dir1, dir2)
+        while (files := await loop.run_in_executor(None, next, scan, None)) is not None:
+            # Waits while the queue is full, so the scan stays just ahead of the workers
+            await to_compress.put(files)
+        for _ in range(workers):
+            await to_compress.put(None)
+
+    async def worker():
+        while (files := await to_compress.get()) is not None:
+            try:
+                compress_success, src_file = await loop.run_in_executor(executor, _compress_one, files)
+            except Exception as e:
+                # The worker process died (e.g. killed for memory), the pool is broken
+                src_file = files[0]
+                logging.error("Error compressing file %s: %r", src_file, e)
+                compress_success = False
+            if compress_success:
+                await to_delete.put(src_file)
+            else:
+                logging.error("Failed to process file: %s", src_file)
+
+    async def deleter():
+        # Delete the original here, once its archive is written
+        while (src_file := await to_delete.get()) is not None:
+            if delete_file(src_file):
+                logging.info("Successfully processed %s", src_file)
+            else:
+                logging.error("Failed to process file: %s", src_file)
+
+    deleter_task = asyncio.create_task(deleter())
+    await asyncio.gather(walker(), *(worker() for _ in range(workers)))
+    await to_delete.put(None)
+    await deleter_task
+
 def process_log_files(dir1, dir2, log_file_path):
     """
-    Processes log files in dir1 that are larger than 500MB, copies them to dir2,
-    compresses the copy, and deletes the original in dir1.
+    Processes log files in dir1 that are larger than 500MB, compresses them
+    into dir2 in parallel, and deletes the originals in dir1 as soon as
+    their archives are written.
+
+    The workers are started with forkserver or spawn (see MP_CONTEXT), which
+    import the main module again. A script that calls this function must do
+    so under an `if __name__ == "__main__":` guard.
 
     Args:
         dir1 (str): The path to the source directory.
@@ -117,47 +398,27 @@ def process_log_files(dir1, dir2, log_file_path):
         log_file_path (str): Path to the log file.
     """
     configure_logging(log_file_path)
-    logging.info(f"Starting log file processing from {dir1} to {dir2}")
+    logging.info("Starting log file processing from %s to %s", dir1, dir2)
 
-    if not os.path.exists(dir1):
-        logging.error(f"Source directory does not exist: {dir1}")
+    try:
+        same_dir = os.path.samefile(dir1, dir2)
+    except OSError as e:
+        if e.filename == dir1:
+            logging.error("Source directory does not exist: %s", dir1)
+        else:
+            logging.error("Destination directory does not exist: %s", dir2)
         return
-    if not os.path.exists(dir2):
-        logging.error(f"Destination directory does not exist: {dir2}")
+    if same_dir:
+        # The archives would be picked up again on the next run
+        logging.warning("Source and destination are the same directory, skipping: %s", dir1)
         return
 
-    for filename in os.listdir(dir1):
-        src_file = os.path.join(dir1, filename)
-        if not os.path.isfile(src_file):
-            continue  # Skip directories and non-files
-
-        file_size_mb = get_file_size_mb(src_file)
-        if file_size_mb > 500:
-            logging.info(f"Found large file: {src_file} ({file_size_mb:.2f} MB)")
-
-            # Create destination filename
-            dest_file = os.path.join(dir2, filename)
-            compressed_file = dest_file + '.gz'
-
-            # Copy the file
-            copy_success = copy_file(src_file, dest_file)
-
-            if copy_success:
-                # Compress the copied file
-                compress_success = compress_file(dest_file, compressed_file)
-                if compress_success:
-                    # Delete the original file
-                    delete_success = delete_file(dest_file)
-                    if delete_success:
-                        logging.info(f"Successfully processed {src_file}")
-                    else:
-                        logging.error(f"Failed to delete original file: {dest_file}")
-                else:
-                    logging.error(f"Failed to compress file: {dest_file}")
-            else:
-                logging.error(f"Failed to copy file: {src_file}")
-        else:
-            logging.info(f"Skipping file: {src_file} ({file_size_mb:.2f} MB) - Size is not greater than 500MB")
+    # Compress the large files in parallel, at most one worker per CPU core
+    max_workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=MP_CONTEXT,
+                             initializer=_init_worker,
+                             initargs=(_log_queue, logging.getLogger().level)) as executor:
+        asyncio.run(_process(dir1, dir2, executor, max_workers))
 
     logging.info("Log file processing complete.")
 
@@ -7,109 +7,391 @@
 # Cheers! - Fernando Cabal - 2 avril 2025
 """
 import os
-import shutil
-import gzip
+import atexit
+import errno
+import mmap
 import time
 import logging
+import logging.handlers
 import sys
+import multiprocessing
+import queue
+import threading
+import contextlib
+import itertools
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    # igzip d'ISA-L remplace gzip de façon transparente et plus rapide, s'il est installé
+    from isal import igzip as gzip_mod
+    COMPRESS_LEVEL = 1  # Le niveau 1 d'ISA-L compresse à peu près comme le niveau 6 de zlib
+except ImportError:
+    import gzip as gzip_mod
+    COMPRESS_LEVEL = 6
+
+# Blocs de 1 Mio pour lire, compresser et écrire les gros fichiers journaux
+BUFFER_SIZE = 1024 * 1024
+# Les fichiers plus grands que ceci sont compressés puis supprimés
+THRESHOLD_BYTES = 500 * 1024 * 1024
+# Blocs lus en arrière-plan en avance sur le compresseur
+READ_AHEAD_DEPTH = 8
+# Enregistrements de journal mis en tampon avant d'être écrits dans le fichier journal
+LOG_BUFFER_CAPACITY = 1024
+
+# Les processus de compression sont démarrés avec forkserver, ou spawn s'il
+# n'existe pas. Ils ne sont alors démarrés que s'il y a du travail pour eux, et
+# jamais forkés depuis ce processus pendant que ses threads de journalisation tournent.
+MP_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# Les enregistrements de journal de ce processus et des processus de compression
+# passent par cette file vers un seul thread d'écoute qui les formate et les écrit
+_log_queue = None
+_log_listener = None
+
+def _start_log_listener(*handlers):
+    """
+    Démarre le thread d'écoute qui passe les enregistrements mis dans _log_queue
+    aux gestionnaires donnés.
+
+    Args:
+        *handlers (logging.Handler): Les gestionnaires auxquels vont les enregistrements.
+    """
+    global _log_queue, _log_listener
+    # Une file multiprocessing, pour que les processus de travail puissent aussi y écrire
+    _log_queue = MP_CONTEXT.Queue(-1)
+    _log_listener = logging.handlers.QueueListener(_log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    # S'exécute avant le nettoyage propre à logging, qui a été enregistré en premier
+    atexit.register(_log_listener.stop)
 
 def configure_logging(log_file_path):
     """
-    Configure la journalisation pour écrire dans un fichier journal spécifié.
+    Configure la journalisation pour écrire dans un fichier journal spécifié. Si
+    l'appelant a déjà configuré la journalisation, ses gestionnaires sont conservés
+    et reçoivent seulement, par la file, les enregistrements des processus de compression.
+
+    Les appels de journalisation ne font que mettre l'enregistrement dans une file,
+    un thread d'écoute en arrière-plan l'écrit dans le fichier journal et sur la console.
 
     Args:
         log_file_path (str): Le chemin d'accès au fichier journal.
     """
+    root = logging.getLogger()
+    if root.handlers:
+        if _log_queue is None:
+            # Configurée par l'appelant, les processus de travail journalisent quand même vers ses gestionnaires
+            _start_log_listener(*root.handlers)
+        return
+
     # Créer le répertoire s'il n'existe pas
     log_dir = os.path.dirname(log_file_path)
-    if log_dir and not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
 
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_file_path),
-            logging.StreamHandler(sys.stdout)  # Aussi journaliser sur la console
-        ]
-    )
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    # N'ouvrir le fichier journal qu'une fois qu'il y a quelque chose à écrire
+    file_handler = logging.FileHandler(log_file_path, delay=True)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler(sys.stdout)  # Aussi journaliser sur la console
+    console_handler.setFormatter(formatter)
 
-def get_file_size_mb(file_path):
+    _start_log_listener(
+        # Écrire le fichier journal par lots, les erreurs sont écrites tout de suite
+        logging.handlers.MemoryHandler(LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR,
+                                       target=file_handler),
+        console_handler)
+
+    root.addHandler(logging.handlers.QueueHandler(_log_queue))
+    root.setLevel(logging.INFO)
+
+def read_chunks(read, read_ahead=0):
     """
-    Obtient la taille d'un fichier en mégaoctets.
+    Produit les blocs renvoyés par read() jusqu'à ce qu'il renvoie b''. Avec read_ahead,
+    un thread en arrière-plan garde autant de blocs en file d'attente pour que les
+    lectures disque se superposent à la compression (les lectures et zlib libèrent le GIL).
 
     Args:
-        file_path (str): Le chemin d'accès au fichier.
-
-    Returns:
-        float: La taille du fichier en mégaoctets, ou 0 si le fichier n'existe pas ou si une erreur se produit.
+        read (callable): Renvoie le bloc suivant, ou b'' en fin de fichier.
+        read_ahead (int): Nombre de blocs à lire en avance, 0 pour lire de façon synchrone.
     """
+    if not read_ahead:
+        yield from iter(read, b'')
+        return
+
+    chunks = queue.Queue(maxsize=read_ahead)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                chunk = read()
+                chunks.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            chunks.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
     try:
-        if os.path.exists(file_path):
-            return os.path.getsize(file_path) / (1024 * 1024)  # Convertir les octets en MB
-        else:
-            logging.warning(f"Fichier non trouvé : {file_path}")
-            return 0
-    except Exception as e:
-        logging.error(f"Erreur lors de l'obtention de la taille du fichier pour {file_path} : {e}")
-        return 0
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        # Libérer la file pour qu'un lecteur bloqué voie le signal d'arrêt
+        stop.set()
+        while not chunks.empty():
+            chunks.get_nowait()
+        thread.join()
 
-def compress_file(input_file, output_file):
+def advise(fd, advice):
     """
-    Compresse un fichier en utilisant gzip.
+    Indique au noyau comment un fichier entier sera accédé. Ne fait rien là
+    où posix_fadvise n'est pas disponible (ex. macOS).
+
+    Args:
+        fd (int): Un descripteur de fichier ouvert.
+        advice (str): Nom d'une constante os.POSIX_FADV_*.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+@contextlib.contextmanager
+def open_for_reading(input_file, buffers=1):
+    """
+    Ouvre un fichier pour le lire une seule fois par blocs de BUFFER_SIZE. Si le
+    système de fichiers prend en charge O_DIRECT, le fichier est lu directement dans
+    un tampon aligné, pour qu'un gros journal ne passe pas par le cache de pages et
+    n'en chasse pas d'autres données.
+
+    Les blocs sont des memoryview sur un anneau de tampons préalloués et réutilisés
+    à tour de rôle, aucun objet bytes n'est donc alloué par bloc. Un bloc est écrasé
+    par la lecture qui a lieu `buffers` lectures plus tard.
 
     Args:
         input_file (str): Le chemin d'accès au fichier d'entrée.
-        output_file (str): Le chemin d'accès au fichier de sortie (compressé).
+        buffers (int): Nombre de blocs qui peuvent être utilisés en même temps.
+
+    Yields:
+        callable: Renvoie le bloc suivant, ou un bloc vide en fin de fichier.
     """
+    # O_DIRECT exige des tampons alignés, les mmap anonymes sont alignés sur la page.
+    # Le mmap est libéré une fois le dernier bloc qui pointe dessus relâché.
+    ring = memoryview(mmap.mmap(-1, BUFFER_SIZE * buffers))
+    views = itertools.cycle([ring[i:i + BUFFER_SIZE] for i in range(0, len(ring), BUFFER_SIZE)])
+
+    fd = None
+    if hasattr(os, 'O_DIRECT'):
+        try:
+            fd = os.open(input_file, os.O_RDONLY | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    if fd is None:
+        # O_DIRECT n'est pas pris en charge ici (ex. tmpfs ou macOS), lectures avec tampon
+        with open(input_file, 'rb', buffering=BUFFER_SIZE) as infile:
+            # Le journal est lu une fois du début à la fin, puis supprimé
+            advise(infile.fileno(), 'POSIX_FADV_SEQUENTIAL')
+
+            def read_buffered():
+                view = next(views)
+                return view[:infile.readinto(view)]
+
+            yield read_buffered
+            advise(infile.fileno(), 'POSIX_FADV_DONTNEED')
+        return
+
+    def read_direct():
+        view = next(views)
+        return view[:os.readv(fd, [view])]
+
     try:
-        with open(input_file, 'rb') as infile, gzip.open(output_file, 'wb') as outfile:
-            shutil.copyfileobj(infile, outfile)
-        logging.info(f"Fichier compressé avec succès : {input_file} vers {output_file}")
-        return True
-    except Exception as e:
-        logging.error(f"Erreur lors de la compression du fichier {input_file} : {e}")
-        return False
+        yield read_direct
+        # Retirer du cache ce que d'autres lecteurs auraient pu y laisser
+        advise(fd, 'POSIX_FADV_DONTNEED')
+    finally:
+        os.close(fd)
 
-def copy_file(src_file, dest_file):
+def compress_file(input_file, output_file, read_ahead=READ_AHEAD_DEPTH):
     """
-    Copie un fichier de la source vers la destination.
+    Compresse un fichier en utilisant gzip.
 
     Args:
-        src_file (str): Chemin d'accès au fichier source.
-        dest_file (str): Chemin d'accès au fichier de destination.
+        input_file (str): Le chemin d'accès au fichier d'entrée.
+        output_file (str): Le chemin d'accès au fichier de sortie (compressé).
+        read_ahead (int): Nombre de blocs lus en avance sur le compresseur, 0 pour désactiver.
     """
     try:
-        # Assurer que le répertoire de destination existe
-        dest_dir = os.path.dirname(dest_file)
-        if dest_dir and not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
-        shutil.copy2(src_file, dest_file)  # Copier avec les métadonnées
-        logging.info(f"Fichier copié avec succès : {src_file} vers {dest_file}")
+        # Les blocs peuvent être en file d'attente, en cours de compression ou de lecture
+        with open_for_reading(input_file, buffers=read_ahead + 2) as read, \
+                open(output_file, 'wb', buffering=BUFFER_SIZE) as rawfile:
+            chunks = read_chunks(read, read_ahead)
+            with contextlib.closing(chunks), \
+                    gzip_mod.GzipFile(fileobj=rawfile, mode='wb', compresslevel=COMPRESS_LEVEL) as outfile:
+                for chunk in chunks:
+                    outfile.write(chunk)
+            # S'assurer que l'archive est sur le disque avant de supprimer l'original
+            rawfile.flush()
+            os.fsync(rawfile.fileno())
+            # L'archive n'est pas relue, ses pages peuvent partir une fois sur le disque
+            advise(rawfile.fileno(), 'POSIX_FADV_DONTNEED')
+        logging.info("Fichier compressé avec succès : %s vers %s", input_file, output_file)
         return True
     except Exception as e:
-        logging.error(f"Erreur lors de la copie du fichier {src_file} vers {dest_file} : {e}")
+        logging.error("Erreur lors de la compression du fichier %s : %s", input_file, e)
         return False
 
 def delete_file(file_path):
     """
-    Supprime un fichier.
+    Supprime un fichier. Un fichier déjà absent compte comme supprimé.
 
     Args:
         file_path (str): Le chemin d'accès au fichier à supprimer.
     """
     try:
         os.remove(file_path)
-        logging.info(f"Fichier supprimé avec succès : {file_path}")
+        logging.info("Fichier supprimé avec succès : %s", file_path)
+        return True
+    except FileNotFoundError:
+        logging.warning("Fichier déjà supprimé : %s", file_path)
         return True
     except Exception as e:
-        logging.error(f"Erreur lors de la suppression du fichier {file_path} : {e}")
+        logging.error("Erreur lors de la suppression du fichier %s : %s", file_path, e)
         return False
 
+def _init_worker(log_queue, level):
+    """
+    Envoie les enregistrements de journal d'un processus de compression au
+    thread d'écoute du processus parent.
+
+    Args:
+        log_queue (multiprocessing.Queue): La file lue par le thread d'écoute.
+        level (int): Le niveau du logger racine du processus parent.
+    """
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+
+def _compress_one(files):
+    """
+    Compresse un fichier dans un processus de travail. L'original est conservé
+    afin que les suppressions restent dans le processus parent.
+
+    Args:
+        files (tuple): Chemins d'accès au fichier source et au fichier de sortie (compressé).
+
+    Returns:
+        tuple: Si la compression a réussi, et le chemin d'accès au fichier source.
+    """
+    src_file, compressed_file = files
+    return compress_file(src_file, compressed_file), src_file
+
+def _scan_large_files(dir1, dir2):
+    """
+    Parcourt dir1 à la recherche des fichiers journaux plus grands que 500MB.
+
+    Args:
+        dir1 (str): Le chemin d'accès au répertoire source.
+        dir2 (str): Le chemin d'accès au répertoire de destination.
+
+    Yields:
+        tuple: Chemins d'accès à un gros fichier et à son fichier compressé dans dir2.
+    """
+    with os.scandir(dir1) as entries:
+        for entry in entries:
+            # DirEntry connaît le type de fichier grâce au parcours du répertoire (d_type),
+            # seuls les fichiers ordinaires coûtent donc un appel stat pour leur taille.
+            # TO DO : sous macOS, getattrlistbulk pourrait renvoyer noms, types et tailles
+            # pour tout un lot d'entrées en un seul appel.
+            if not entry.is_file(follow_symlinks=False):
+                continue  # Ignorer les répertoires, les liens symboliques et les non-fichiers
+
+            src_file = entry.path
+            try:
+                file_size = entry.stat(follow_symlinks=False).st_size
+            except OSError as e:
+                # Renommé ou supprimé depuis la lecture du répertoire
+                logging.warning("Erreur lors de l'obtention de la taille du fichier pour %s : %s", src_file, e)
+                continue
+            if file_size <= THRESHOLD_BYTES:
+                logging.info("Fichier ignoré : %s (%d MB) - La taille n'est pas supérieure à 500MB", src_file, file_size >> 20)
+                continue
+
+            logging.info("Fichier volumineux trouvé : %s (%d MB)", src_file, file_size >> 20)
+
+            # Créer un nom de fichier de destination
+            compressed_file = os.path.join(dir2, entry.name + '.gz')
+            yield src_file, compressed_file
+
+async def _process(dir1, dir2, executor, workers):
+    """
+    Compresse les gros fichiers journaux de dir1 dans dir2 et supprime les originaux,
+    en pipeline : le parcours alimente une file bornée, les processus de compression
+    y prennent les fichiers dès qu'ils sont libres, et un suppresseur retire chaque
+    original dès que son archive est écrite. Le parcours du fichier suivant et la
+    suppression du précédent se superposent tous deux à la compression.
+
+    Args:
+        dir1 (str): Le chemin d'accès au répertoire source.
+        dir2 (str): Le chemin d'accès au répertoire de destination.
+        executor (ProcessPoolExecutor): Le pool dans lequel les fichiers sont compressés.
+        workers (int): Nombre de fichiers compressés en même temps.
+    """
+    loop = asyncio.get_running_loop()
+    to_compress = asyncio.Queue(maxsize=workers)
+    to_delete = asyncio.Queue()
+
+    async def walker():
+        # Le parcours bloque sur readdir et lstat, il tourne donc dans un thread
+        scan = _scan_large_files(dir1, dir2)
+        while (files := await loop.run_in_executor(None, next, scan, None)) is not None:
+            # Attend tant que la file est pleine, le parcours reste juste en avance sur les processus
+            await to_compress.put(files)
+        for _ in range(workers):
+            await to_compress.put(None)
+
+    async def worker():
+        while (files := await to_compress.get()) is not None:
+            try:
+                compress_success, src_file = await loop.run_in_executor(executor, _compress_one, files)
+            except Exception as e:
+                # Le processus de travail est mort (ex. tué faute de mémoire), le pool est cassé
+                src_file = files[0]
+                logging.error("Erreur lors de la compression du fichier %s : %r", src_file, e)
+                compress_success = False
+            if compress_success:
+                await to_delete.put(src_file)
+            else:
+                logging.error("Échec du traitement du fichier : %s", src_file)
+
+    async def deleter():
+        # Supprimer l'original ici, une fois son archive écrite
+        while (src_file := await to_delete.get()) is not None:
+            if delete_file(src_file):
+                logging.info("Fichier traité avec succès : %s", src_file)
+            else:
+                logging.error("Échec du traitement du fichier : %s", src_file)
+
+    deleter_task = asyncio.create_task(deleter())
+    await asyncio.gather(walker(), *(worker() for _ in range(workers)))
+    await to_delete.put(None)
+    await deleter_task
+
 def process_log_files(dir1, dir2, log_file_path):
     """
-    Traite les fichiers journaux dans dir1 qui sont plus grands que 500MB, les copie dans dir2,
-    compresse la copie, et supprime l'original dans dir1.
+    Traite les fichiers journaux dans dir1 qui sont plus grands que 500MB, les compresse
+    en parallèle dans dir2, et supprime les originaux dans dir1 dès que leurs
+    archives sont écrites.
+
+    Les processus de travail sont démarrés avec forkserver ou spawn (voir MP_CONTEXT),
+    qui importent de nouveau le module principal. Un script qui appelle cette fonction
+    doit le faire sous une garde `if __name__ == "__main__":`.
 
     Args:
         dir1 (str): Le chemin d'accès au répertoire source.
@@ -117,47 +399,27 @@ def process_log_files(dir1, dir2, log_file_path):
         log_file_path (str): Chemin d'accès au fichier journal.
     """
     configure_logging(log_file_path)
-    logging.info(f"Début du traitement des fichiers journaux de {dir1} vers {dir2}")
+    logging.info("Début du traitement des fichiers journaux de %s vers %s", dir1, dir2)
 
-    if not os.path.exists(dir1):
-        logging.error(f"Le répertoire source n'existe pas : {dir1}")
+    try:
+        same_dir = os.path.samefile(dir1, dir2)
+    except OSError as e:
+        if e.filename == dir1:
+            logging.error("Le répertoire source n'existe pas : %s", dir1)
+        else:
+            logging.error("Le répertoire de destination n'existe pas : %s", dir2)
         return
-    if not os.path.exists(dir2):
-        logging.error(f"Le répertoire de destination n'existe pas : {dir2}")
+    if same_dir:
+        # Les archives seraient reprises à la prochaine exécution
+        logging.warning("La source et la destination sont le même répertoire, rien n'est fait : %s", dir1)
         return
 
-    for filename in os.listdir(dir1):
-        src_file = os.path.join(dir1, filename)
-        if not os.path.isfile(src_file):
-            continue  # Ignorer les répertoires et les non-fichiers
-
-        file_size_mb = get_file_size_mb(src_file)
-        if file_size_mb > 500:
-            logging.info(f"Fichier volumineux trouvé : {src_file} ({file_size_mb:.2f} MB)")
-
-            # Créer un nom de fichier de destination
-            dest_file = os.path.join(dir2, filename)
-            compressed_file = dest_file + '.gz'
-
-            # Copier le fichier
-            copy_success = copy_file(src_file, dest_file)
-
-            if copy_success:
-                # Compresser le fichier copié
-                compress_success = compress_file(dest_file, compressed_file)
-                if compress_success:
-                    # Supprimer le fichier original
-                    delete_success = delete_file(dest_file)
-                    if delete_success:
-                        logging.info(f"Fichier traité avec succès : {src_file}")
-                    else:
-                        logging.error(f"Échec de la suppression du fichier original : {dest_file}")
-                else:
-                    logging.error(f"Échec de la compression du fichier : {dest_file}")
-            else:
-                logging.error(f"Échec de la copie du fichier : {src_file}")
-        else:
-            logging.info(f"Fichier ignoré : {src_file} ({file_size_mb:.2f} MB) - La taille n'est pas supérieure à 500MB")
+    # Compresser les gros fichiers en parallèle, au plus un processus par cœur
+    max_workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=MP_CONTEXT,
+                             initializer=_init_worker,
+                             initargs=(_log_queue, logging.getLogger().level)) as executor:
+        asyncio.run(_process(dir1, dir2, executor, max_workers))
 
     logging.info("Traitement des fichiers journaux terminé.")
 
@@ -5,60 +5,169 @@
 # TO DO :  Provie information that can be used to configure SIEM and log analysis tools.
 # TO DO :  Add pattern definitions from vendors, try to detect what vendor , application or device did generate the file by using a database with knowledge.
 
+import contextlib
+import mmap
+import os
 import re
+import stat
 import sys
+from collections import Counter
 from datetime import datetime
 
-# Define regex patterns for common syslog formats
-RFC3164_PATTERN = re.compile(r'^(<\d+>)?(?P<timestamp>\w{3} \d{1,2} \d{2}:\d{2}:\d{2}) ([\w.-]+) (.+)$')
-RFC5424_PATTERN = re.compile(r'^(<\d+>\d )?(?P<timestamp>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{1,6}Z) ([\w.-]+) ([\w.-]+) (\d+) (\[.*?\]|-) (.+)$')
+# Define a single regex for the common syslog formats. RFC 3164 is tried first
+# as it is the cheaper and more common one, and one match call tells them apart.
+# Patterns work on bytes so lines can be matched straight from a mapped file.
+# \w only matches ASCII in bytes patterns, so host and app names also accept
+# the bytes of UTF-8 encoded non-ASCII characters.
+SYSLOG_PATTERN = re.compile(
+    rb'^(?:'
+    rb'(?:<\d+>)?(?P<ts3164>\w{3} \d{1,2} \d{2}:\d{2}:\d{2}) [\w.\x80-\xff-]+ .+'
+    rb'|(?:<\d+>\d )?(?P<ts5424>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{1,6}Z) [\w.\x80-\xff-]+ [\w.\x80-\xff-]+ \d+ (?:\[.*?\]|-) .+'
+    rb')$'
+)
+
+# Same pattern over a whole file, one line per match
+SYSLOG_BULK_PATTERN = re.compile(rb'^[^\S\n]*' + SYSLOG_PATTERN.pattern[1:], re.MULTILINE)
+NON_EMPTY_LINE_PATTERN = re.compile(rb'^[^\S\n]*\S', re.MULTILINE)
+
+MONTHS = {month: number for number, month in enumerate(
+    ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), start=1)}
+
+
+def parse_rfc3164_timestamp(timestamp):
+    """Parses a 'Mmm d HH:MM:SS' timestamp matched by SYSLOG_PATTERN, without
+    going through strptime. Like strptime, the year defaults to 1900."""
+    month = MONTHS.get(timestamp[:3].title())
+    if month is None:
+        raise ValueError(f"unknown month: {timestamp[:3]}")
+    day, clock = timestamp[4:].split(" ")
+    return datetime(1900, month, int(day), int(clock[0:2]), int(clock[3:5]), int(clock[6:8]))
+
+
+def parse_rfc5424_timestamp(timestamp):
+    """Parses a 'YYYY-MM-DDTHH:MM:SS.ffffffZ' timestamp matched by SYSLOG_PATTERN,
+    without going through strptime."""
+    return datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                    int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+                    int(timestamp[20:-1].ljust(6, "0")))
 
 
 def detect_syslog_format(log_line):
     """Detects the format of a given syslog line and extracts timestamp."""
-    match_5424 = RFC5424_PATTERN.match(log_line)
-    match_3164 = RFC3164_PATTERN.match(log_line)
-    
-    if match_5424:
-        timestamp = match_5424.group("timestamp")
-        try:
-            parsed_timestamp = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-        except ValueError:
-            parsed_timestamp = None
-        return "RFC 5424 (Structured Data)", timestamp, parsed_timestamp
-    
-    elif match_3164:
-        timestamp = match_3164.group("timestamp")
+    return detect_syslog_format_bytes(log_line.encode('utf-8'))
+
+
+def detect_syslog_format_bytes(log_line):
+    """Same as detect_syslog_format for a line given as bytes."""
+    match = SYSLOG_PATTERN.match(log_line)
+    if not match:
+        return "Unknown Format", None, None
+
+    timestamp = match.group("ts3164")
+    if timestamp:
+        timestamp = timestamp.decode('ascii')
         try:
-            parsed_timestamp = datetime.strptime(timestamp, "%b %d %H:%M:%S")
+            parsed_timestamp = parse_rfc3164_timestamp(timestamp)
         except ValueError:
             parsed_timestamp = None
         return "RFC 3164 (Traditional Format)", timestamp, parsed_timestamp
-    
-    return "Unknown Format", None, None
+
+    timestamp = match.group("ts5424").decode('ascii')
+    try:
+        parsed_timestamp = parse_rfc5424_timestamp(timestamp)
+    except ValueError:
+        parsed_timestamp = None
+    return "RFC 5424 (Structured Data)", timestamp, parsed_timestamp
+
+
+def is_mappable(file):
+    """Tells whether an open file can be mapped. Pipes, FIFOs, procfs files and
+    empty files cannot."""
+    st = os.fstat(file.fileno())
+    return stat.S_ISREG(st.st_mode) and st.st_size > 0
+
+
+@contextlib.contextmanager
+def map_file(file_path):
+    """Maps a file read-only into memory. Files that cannot be mapped are read
+    in full instead."""
+    with open(file_path, 'rb') as file:
+        if not is_mappable(file):
+            yield file.read()
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
 
 
-def analyze_syslog_file(file_path):
-    """Reads a syslog file and attempts to determine its format and timestamp."""
+def first_non_empty_line(data):
+    """Returns the first non-empty line of mapped data, stripped, or None if there is none."""
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start)
+        if end == -1:
+            end = len(data)
+        line = data[start:end].strip()
+        if line:
+            return line
+        start = end + 1
+    return None
+
+
+def read_first_non_empty_line(file_path):
+    """Returns the first non-empty line of a file, stripped, or None if there is none.
+    Pipes and other streams are read line by line, so this returns as soon as
+    the line arrives."""
+    with open(file_path, 'rb') as file:
+        if is_mappable(file):
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return first_non_empty_line(data)
+        for line in file:
+            line = line.strip()
+            if line:
+                return line
+    return None
+
+
+def analyze_syslog_bulk(file_path):
+    """Counts the syslog format of every non-empty line of a file in one regex pass."""
+    with map_file(file_path) as data:
+        counts = Counter(match.lastgroup for match in SYSLOG_BULK_PATTERN.finditer(data))
+        non_empty_lines = sum(1 for _ in NON_EMPTY_LINE_PATTERN.finditer(data))
+    return {
+        "RFC 3164 (Traditional Format)": counts["ts3164"],
+        "RFC 5424 (Structured Data)": counts["ts5424"],
+        "Unknown Format": non_empty_lines - counts["ts3164"] - counts["ts5424"],
+    }
+
+
+def analyze_syslog_file(file_path, stats=False):
+    """Reads a syslog file and attempts to determine its format and timestamp.
+    With stats, counts the formats of all lines instead of the first one."""
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            for line in file:
-                line = line.strip()
-                if line:
-                    detected_format, timestamp, parsed_timestamp = detect_syslog_format(line)
-                    print(f"Detected: {detected_format} -> {line}")
-                    if timestamp:
-                        print(f"Extracted Timestamp: {timestamp}")
-                        print(f"Parsed Timestamp: {parsed_timestamp}")
-                    break  # Only analyze the first non-empty line
+        if stats:
+            for detected_format, count in analyze_syslog_bulk(file_path).items():
+                print(f"{detected_format}: {count} lines")
+            return
+
+        line = read_first_non_empty_line(file_path)  # Only analyze the first non-empty line
+        if line:
+            detected_format, timestamp, parsed_timestamp = detect_syslog_format_bytes(line)
+            print(f"Detected: {detected_format} -> {line.decode('utf-8', errors='replace')}")
+            if timestamp:
+                print(f"Extracted Timestamp: {timestamp}")
+                print(f"Parsed Timestamp: {parsed_timestamp}")
     except Exception as e:
         print(f"Error reading file: {e}")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python detect_syslog_format.py <syslog_file>")
+    args = sys.argv[1:]
+    stats = "--stats" in args
+    if stats:
+        args.remove("--stats")
+    if len(args) != 1:
+        print("Usage: python detect_syslog_format.py [--stats] <syslog_file>")
         sys.exit(1)
     
-    file_path = sys.argv[1]
-    analyze_syslog_file(file_path)
+    file_path = args[0]
+    analyze_syslog_file(file_path, stats)